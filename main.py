@@ -1,21 +1,66 @@
 import cv2
+import functools
+import os
+import queue
+import sys
 import time
 import requests
 import json
 import threading
 import webbrowser
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
 from ultralytics import YOLO
 
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    jpeg = TurboJPEG()
+except Exception:  # PyTurboJPEG or libturbojpeg not installed
+    jpeg = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # --- 1. CONFIGURATION ---
 
 # CHANGE THIS IP TO MATCH YOUR ESP32'S IP ADDRESS 
 ESP32_URL = "http://192.168.0.148/update" 
 MODEL_PATH = "model/best.pt" # Ensure this path is correct
+ENGINE_PATH = "model/best.engine" # TensorRT engine, exported from MODEL_PATH on first run
+OPENVINO_PATH = "model/best_openvino_model" # Used instead of ENGINE_PATH on CPU-only machines
+USE_INT8 = False             # Export INT8 instead of FP16/FP32 (requires CALIB_DATA)
+CALIB_DATA = "calib.yaml"    # Dataset yaml pointing at representative camera frames
+CAMERA_SOURCES = [0]         # Camera indices/URLs; all cameras share one batched YOLO call
+                             # (delete exported models after changing the number of cameras)
+BATCH_SIZE = len(CAMERA_SOURCES)
+CAPTURE_WIDTH = 640          # Requested camera resolution (most webcams are 4:3). Both must
+CAPTURE_HEIGHT = 480         # be multiples of 32 (the YOLO stride) or frames get padded
+CAPTURE_FPS = 30
+# Inference resolution (h, w). It equals the capture size so frames go into YOLO
+# without a letterbox resize (delete exported models after changing it)
+IMG_SIZE = (CAPTURE_HEIGHT, CAPTURE_WIDTH)
+MOTION_SIZE = (64, 64)       # Thumbnail size used to detect scene changes
+MOTION_THRESHOLD = 2.0       # Mean abs pixel difference below which inference is skipped
+MAX_SKIP = 30                # Run inference at least every N frames (~1 s at 30 FPS) so a
+                             # small local change (e.g. a mask removed) is never missed
+USE_CUDA = torch.cuda.is_available()
+DEVICE = 0 if USE_CUDA else 'cpu'
+PPE_VIOLATIONS = {           # Status key -> label of the class that means it is MISSING
+    "hardhat": "NO-Hardhat",
+    "vest": "NO-Safety Vest",
+    "mask": "NO-Mask",
+}
 SEND_INTERVAL = 1.0          # How often to send data to ESP32 (seconds)
 SERVER_PORT = 8000
 SERVER_URL = f"http://localhost:{SERVER_PORT}"
 HTML_FILE_PATH = "index.html" # Path to the HTML file we are serving
+JPEG_QUALITY = 80            # Quality of the MJPEG video feed frames
+SHOW_WINDOW = os.getenv('PPE_DEBUG', '0') == '1'  # Local OpenCV debug window (PPE_DEBUG=1)
+WINDOW_NAME = "PPE Detection"
+WINDOW_SIZE = (480, 360)     # Debug window is drawn downscaled to keep the blit cheap
 
 # --- 2. GLOBAL STATE (Shared between threads) ---
 
@@ -28,12 +73,55 @@ current_ppe_status = {
 
 status_lock = threading.Lock()
 
-# Global variable to store the latest frame
-latest_frame = None
+# Latest status waiting to be sent to the ESP32 (stale updates are dropped)
+esp32_queue = queue.Queue(maxsize=1)
+
+# Global variable to store the JPEG encoding of the latest frame.
+# The frame is encoded once in cv_loop and shared by every video client.
+latest_jpeg = None
+frame_seq = 0  # Incremented every time a new frame is published
 frame_lock = threading.Lock()
+frame_cond = threading.Condition(frame_lock)
+
+# Number of connected video clients; frames are only drawn and encoded when > 0
+active_viewers = 0
+viewer_lock = threading.Lock()
+
+def encode_jpeg(frame):
+    """Encodes a BGR frame as JPEG bytes, using libjpeg-turbo when available."""
+    if jpeg is not None:
+        return jpeg.encode(frame, quality=JPEG_QUALITY, pixel_format=TJPF_BGR)
+    ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    return buffer.tobytes() if ret else None
+
+def dumps_json(obj):
+    """Serializes obj to JSON bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+def load_html_content():
+    """Loads the raw bytes of the index.html file (already UTF-8 encoded)."""
+    try:
+        with open(HTML_FILE_PATH, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        error_message = f"Error: {HTML_FILE_PATH} not found. Ensure it is in the same directory."
+        print(f"[SERVER ERROR] {error_message}")
+        return error_message.encode('utf-8')
+    except Exception as e:
+        error_message = f"Error reading {HTML_FILE_PATH}: {e}"
+        print(f"[SERVER ERROR] {error_message}")
+        return error_message.encode('utf-8')
+
+# The dashboard is read once at startup and served from memory (restart to pick up edits)
+HTML_BYTES = load_html_content()
 
 # --- 3. HTTP SERVER CLASS (Runs in a separate thread) ---
 
+# Boundary and headers preceding every JPEG in the MJPEG stream
+MJPEG_PART_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n'
+
 class DashboardHandler(BaseHTTPRequestHandler):
     """Handles requests for the HTML dashboard and the status JSON."""
 
@@ -48,73 +136,54 @@ class DashboardHandler(BaseHTTPRequestHandler):
         else:
             self._send_404()
 
-    def _load_html_content(self):
-        """Loads the content of the index.html file with UTF-8 encoding."""
-        try:
-            with open(HTML_FILE_PATH, 'r', encoding='utf-8') as f:
-                return f.read().encode('utf-8')
-        except FileNotFoundError:
-            error_message = f"Error: {HTML_FILE_PATH} not found. Ensure it is in the same directory."
-            print(f"[SERVER ERROR] {error_message}")
-            return error_message.encode('utf-8')
-        except Exception as e:
-            error_message = f"Error reading {HTML_FILE_PATH}: {e}"
-            print(f"[SERVER ERROR] {error_message}")
-            return error_message.encode('utf-8')
-
     def _send_html(self):
         self.send_response(200)
         self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', len(HTML_BYTES))
         self.end_headers()
-        html_content = self._load_html_content()
-        self.wfile.write(html_content)
+        self.wfile.write(HTML_BYTES)
 
     def _send_status_json(self):
+        # Access the global status variable safely
+        with status_lock:
+            response = current_ppe_status.copy()
+        body = dumps_json(response)
+
         self.send_response(200)
         self.send_header('Content-type', 'application/json')
         # Allow access from the local HTML page (CORS)
         self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-Length', len(body))
         self.end_headers()
-        
-        # Access the global status variable safely
-        with status_lock:
-            response = current_ppe_status.copy()
-        
-        self.wfile.write(json.dumps(response).encode('utf-8'))
+        self.wfile.write(body)
 
     def _send_video_feed(self):
         """Stream the video feed as MJPEG."""
+        global active_viewers
         self.send_response(200)
         self.send_header('Content-type', 'multipart/x-mixed-replace; boundary=frame')
         self.send_header('Access-Control-Allow-Origin', '*')
         self.end_headers()
         
+        with viewer_lock:
+            active_viewers += 1
+        last_seq = -1
         try:
             while True:
-                with frame_lock:
-                    if latest_frame is None:
-                        time.sleep(0.1)
+                # Block until cv_loop publishes a frame this client has not sent yet
+                with frame_cond:
+                    if not frame_cond.wait_for(lambda: latest_jpeg is not None and frame_seq != last_seq, timeout=1.0):
                         continue
-                    frame = latest_frame.copy()
-                
-                # Encode frame as JPEG
-                ret, buffer = cv2.imencode('.jpg', frame)
-                if not ret:
-                    continue
-                
-                frame_bytes = buffer.tobytes()
-                
-                # Send frame in multipart format
-                self.wfile.write(b'--frame\r\n')
-                self.send_header('Content-Type', 'image/jpeg')
-                self.send_header('Content-Length', len(frame_bytes))
-                self.end_headers()
-                self.wfile.write(frame_bytes)
-                self.wfile.write(b'\r\n')
+                    frame_bytes = latest_jpeg
+                    last_seq = frame_seq
                 
-                time.sleep(0.033)  # ~30 FPS
+                # Send frame in multipart format with a single write
+                self.wfile.write(MJPEG_PART_HEADER % len(frame_bytes) + frame_bytes + b'\r\n')
         except Exception as e:
             print(f"[VIDEO FEED ERROR] {e}")
+        finally:
+            with viewer_lock:
+                active_viewers -= 1
 
     def _send_404(self):
         self.send_response(404)
@@ -127,9 +196,9 @@ class DashboardHandler(BaseHTTPRequestHandler):
         pass
 
 def run_server():
-    """Starts the simple HTTP server."""
+    """Starts the HTTP server, handling each request in its own thread."""
     server_address = ('', SERVER_PORT)
-    httpd = HTTPServer(server_address, DashboardHandler)
+    httpd = ThreadingHTTPServer(server_address, DashboardHandler)
     print(f"[SERVER] Starting dashboard server at {SERVER_URL}...")
     try:
         httpd.serve_forever()
@@ -137,102 +206,268 @@ def run_server():
         print("[SERVER] Shutting down server...")
         httpd.server_close()
 
+def esp32_sender():
+    """Sends queued status updates to the ESP32 over a keep-alive session."""
+    session = requests.Session()
+    while True:
+        payload = esp32_queue.get()
+        try:
+            r = session.post(ESP32_URL, json=payload, timeout=0.5)
+            if r.status_code != 200:
+                print(f"[ESP32 WARNING] Response unexpected (Status: {r.status_code})")
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+            print("[ESP32 ERROR] Could not connect to ESP32. Check IP/WiFi.")
+        except Exception as e:
+            print(f"[ESP32 ERROR] Send error: {e}")
+
 # --- 4. COMPUTER VISION LOOP (Main Thread) ---
 
+def load_model():
+    """Loads the fastest model format for this machine, exporting it on first run.
+
+    CUDA machines use a TensorRT engine and CPU-only machines an OpenVINO
+    model. Falls back to the PyTorch weights if the export fails.
+    """
+    export_args = dict(imgsz=IMG_SIZE, dynamic=BATCH_SIZE > 1, batch=BATCH_SIZE)
+    if USE_INT8:
+        export_args.update(int8=True, data=CALIB_DATA)
+    if USE_CUDA:
+        name, path = "TensorRT engine", ENGINE_PATH
+        export_args.update(format='engine', half=not USE_INT8)
+    else:
+        name, path = "OpenVINO model", OPENVINO_PATH
+        export_args.update(format='openvino')
+
+    if not os.path.exists(path):
+        print(f"[YOLO] No {name} at {path}. Exporting from {MODEL_PATH} (one-time)...")
+        try:
+            exported = YOLO(MODEL_PATH).export(**export_args)
+            if exported and os.path.abspath(exported) != os.path.abspath(path):
+                os.replace(exported, path)
+        except Exception as e:
+            print(f"[YOLO WARNING] {name} export failed, using PyTorch weights: {e}")
+            return YOLO(MODEL_PATH)
+
+    return YOLO(path, task='detect')
+
+def open_camera(source):
+    """Opens a camera as compressed MJPG at the inference resolution with a 1-frame buffer."""
+    if isinstance(source, int) and sys.platform.startswith('linux'):
+        cap = cv2.VideoCapture(source, cv2.CAP_V4L2)
+    elif isinstance(source, int) and sys.platform == 'win32':
+        cap = cv2.VideoCapture(source, cv2.CAP_DSHOW)
+    else:
+        cap = cv2.VideoCapture(source)
+
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAPTURE_WIDTH)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAPTURE_HEIGHT)
+    cap.set(cv2.CAP_PROP_FPS, CAPTURE_FPS)
+    # Keep only the newest frame so a slow inference never processes stale images
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    return cap
+
+class CameraStream:
+    """Reads a camera in a background thread, keeping only the newest frame.
+
+    This lets the next frame be captured and decoded while the current one
+    is going through inference.
+    """
+
+    def __init__(self, cap):
+        self.cap = cap
+        self.ok = True
+        self.frame = None
+        self.seq = 0
+        self.last_seq = 0
+        self.running = True
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._capture)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _capture(self):
+        while self.running:
+            ret, frame = self.cap.read()
+            with self.cond:
+                self.ok = ret
+                if ret:
+                    self.frame = frame
+                    self.seq += 1
+                self.cond.notify_all()
+            if not ret:
+                break
+        # Released here, not in release(), so it can never race a cap.read() in progress
+        self.cap.release()
+
+    def read(self):
+        """Like cap.read(), but returns the newest frame not yet returned."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq != self.last_seq or not self.ok)
+            self.last_seq = self.seq
+            return self.ok, self.frame
+
+    def release(self):
+        """Stops the capture thread, which releases the camera once its read returns."""
+        self.running = False
+        self.thread.join(timeout=1)
+
 def cv_loop():
     """Runs the YOLO model and updates the global status."""
-    global current_ppe_status, latest_frame
+    global current_ppe_status, latest_jpeg, frame_seq
     
     print("[YOLO] Initializing model and camera...")
     
     try:
-        model = YOLO(MODEL_PATH)
+        model = load_model()
     except Exception as e:
         print(f"[YOLO ERROR] Error loading model. Check MODEL_PATH: {e}")
         return
 
-    cap = cv2.VideoCapture(0)
-    if not cap.isOpened():
+    # Fix the inference arguments once instead of re-passing them every frame.
+    # Frames go in as uint8 NumPy arrays; YOLO uploads them and does the
+    # uint8 -> half/255 conversion on the device.
+    predict = functools.partial(model, verbose=False, half=USE_CUDA, device=DEVICE, imgsz=IMG_SIZE)
+
+    # Resolve the NO-PPE class IDs once so each frame is a tensor lookup, not a string scan
+    violation_ids = {
+        key: torch.tensor([i for i, name in model.names.items() if label in name], dtype=torch.int64)
+        for key, label in PPE_VIOLATIONS.items()
+    }
+
+    caps = [open_camera(source) for source in CAMERA_SOURCES]
+    if not all(cap.isOpened() for cap in caps):
         print("[YOLO ERROR] Cannot open camera.")
+        for cap in caps:
+            cap.release()
         return
+    streams = [CameraStream(cap) for cap in caps]
+
+    if SHOW_WINDOW:
+        cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
+        cv2.resizeWindow(WINDOW_NAME, *WINDOW_SIZE)
 
     last_send = 0
+    prev_smalls = None
+    skipped = 0
+    annotated_frame = None
+    frame_published = False
     print(f"[YOLO] PPE Detection running. Sending data to ESP32 ({ESP32_URL}) every {SEND_INTERVAL}s.")
+    print("[YOLO] Press 'q' in the debug window to quit." if SHOW_WINDOW else "[YOLO] Press Ctrl+C to quit (set PPE_DEBUG=1 for the debug window).")
 
     try:
         while True:
-            ret, frame = cap.read()
-            if not ret:
+            reads = [stream.read() for stream in streams]
+            if not all(ret for ret, _ in reads):
                 print("[YOLO] Camera error or stream ended")
                 break
-
-            # Run YOLO inference
-            results = model(frame, verbose=False)
+            # Feed YOLO contiguous frames; if a camera ignored the requested
+            # resolution, YOLO letterboxes it to IMG_SIZE keeping the aspect ratio
+            frames = [np.ascontiguousarray(frame) for _, frame in reads]
+
+            # Skip inference when no camera has changed since the last inferred frame,
+            # but never for more than MAX_SKIP frames in a row
+            smalls = [cv2.resize(frame, MOTION_SIZE) for frame in frames]
+            static = prev_smalls is not None and skipped < MAX_SKIP and all(
+                cv2.absdiff(cur, prev).mean() < MOTION_THRESHOLD
+                for cur, prev in zip(smalls, prev_smalls)
+            )
+
+            if static:
+                skipped += 1
+            else:
+                prev_smalls = smalls
+                skipped = 0
+
+                # Run YOLO inference on all cameras in one batch
+                results = predict(frames)
             
-            # --- 4.1 Determine PPE Status ---
-            ppe_status_local = {
-                "hardhat": 1, "vest": 1, "mask": 1
-            }
-
-            annotated_frame = results[0].plot()
-
-            for box in results[0].boxes:
-                cls = int(box.cls[0])
-                label = model.names[cls]
-
-                # Set status to 0 (MISSING) if NO-PPE is detected
-                if "NO-Hardhat" in label:
-                    ppe_status_local["hardhat"] = 0
-                if "NO-Safety Vest" in label:
-                    ppe_status_local["vest"] = 0
-                if "NO-Mask" in label:
-                    ppe_status_local["mask"] = 0
+                # --- 4.1 Determine PPE Status ---
+                # Status is 0 (MISSING) if NO-PPE is detected on any camera
+                cls = torch.cat([result.boxes.cls for result in results]).to('cpu', torch.int64)
+                ppe_status_local = {
+                    key: int(not torch.isin(cls, ids).any())
+                    for key, ids in violation_ids.items()
+                }
+
+                # Drawn lazily below, only if someone is watching
+                annotated_frame = None
+                frame_published = False
 
             # --- 4.2 Update Global Status (for Web Display) ---
             with status_lock:
                 current_ppe_status.update(ppe_status_local)
                 current_ppe_status["timestamp"] = time.time()
 
-            # Update latest frame for video streaming
-            with frame_lock:
-                latest_frame = annotated_frame.copy()
+            # The dashboard and debug window show the first camera
+            viewers = active_viewers
+            if annotated_frame is None and (viewers > 0 or SHOW_WINDOW):
+                annotated_frame = results[0].plot()
+
+            # Update latest frame for video streaming (encoded once for all clients)
+            if viewers > 0 and not frame_published:
+                frame_bytes = encode_jpeg(annotated_frame)
+                with frame_cond:
+                    latest_jpeg = frame_bytes
+                    frame_seq += 1
+                    frame_cond.notify_all()
+                frame_published = True
 
             # Show webcam window (Keep this for debugging CV)
-            cv2.imshow("PPE Detection", annotated_frame)
+            if SHOW_WINDOW:
+                cv2.imshow(WINDOW_NAME, cv2.resize(annotated_frame, WINDOW_SIZE))
 
             # --- 4.3 Send data to ESP32 (Physical Interface) ---
             current_time = time.time()
             if current_time - last_send > SEND_INTERVAL:
+                # Handed off to esp32_sender so network hiccups never stall the CV loop.
+                # If the previous status has not been sent yet, replace it with this one.
                 try:
-                    r = requests.post(ESP32_URL, json=ppe_status_local, timeout=0.5)
-                    if r.status_code != 200:
-                        print(f"[ESP32 WARNING] Response unexpected (Status: {r.status_code})")
-                except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-                    print("[ESP32 ERROR] Could not connect to ESP32. Check IP/WiFi.")
-                except Exception as e:
-                    print(f"[ESP32 ERROR] Send error: {e}")
+                    esp32_queue.put_nowait(ppe_status_local)
+                except queue.Full:
+                    try:
+                        esp32_queue.get_nowait()
+                    except queue.Empty:
+                        pass
+                    esp32_queue.put_nowait(ppe_status_local)
 
                 last_send = current_time
 
             # Handle user exit
-            if cv2.waitKey(1) & 0xFF == ord('q'):
+            if SHOW_WINDOW and cv2.waitKey(1) & 0xFF == ord('q'):
                 break
 
+    except KeyboardInterrupt:
+        pass
     finally:
         # --- 4.4 Cleanup ---
-        cap.release()
-        cv2.destroyAllWindows()
+        for stream in streams:
+            stream.release()
+        if SHOW_WINDOW:
+            cv2.destroyAllWindows()
         print("[YOLO] Application shut down.")
 
 
 # --- 5. MAIN EXECUTION ---
 
 if __name__ == '__main__':
+    # On a free-threaded (python3.13t) build the CV loop, capture threads and
+    # HTTP handlers run in parallel. An extension that is not marked free-thread
+    # safe silently re-enables the GIL at import time, so report what we got.
+    gil_check = getattr(sys, '_is_gil_enabled', None)
+    if gil_check is not None:
+        print(f"[PYTHON] GIL {'enabled' if gil_check() else 'disabled (free-threaded)'}")
+
     # Start the HTTP server in a background thread
     server_thread = threading.Thread(target=run_server)
     server_thread.daemon = True 
     server_thread.start()
 
+    # Start the ESP32 sender in a background thread
+    esp32_thread = threading.Thread(target=esp32_sender)
+    esp32_thread.daemon = True
+    esp32_thread.start()
+
     # Wait a moment for the server to spin up, then open the browser
     time.sleep(1) 
     print(f"[BROWSER] Opening dashboard in web browser: {SERVER_URL}")